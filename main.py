@@ -1,8 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
+import html
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from notion_wrapper import NotionWrapper
 
+# ステータス選択肢の並び順
+_STATUS_ORDER = ("未着手", "進行中", "完了")
+
+# 未着手 / 進行中 とみなすステータス名
+_NOT_STARTED_STATUSES = frozenset(["Not started", "Not Started", "未着手", "To Do", "To-do"])
+_IN_PROGRESS_STATUSES = frozenset(["In progress", "In Progress", "進行中", "Doing"])
+
 # ページ設定
 st.set_page_config(
     page_title="Task App",
@@ -11,10 +22,8 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# カスタムCSSの注入
-def local_css():
-    st.markdown("""
-    <style>
+# カスタムCSS
+_CSS = """
     /* 全体のフォント設定 */
     @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap');
     
@@ -85,39 +94,112 @@ def local_css():
         padding-top: 10px;
         padding-bottom: 10px;
     }
-    </style>
-    """, unsafe_allow_html=True)
+"""
 
-local_css()
 
-# タイトル
-st.title("✅ Task App")
+# カスタムCSSの注入
+# 静的な文字列なのでキャッシュし、リラン時は記録済みの要素を再生するだけにする
+@st.cache_resource(show_spinner=False)
+def local_css():
+    st.markdown(f"<style>{_CSS}</style>", unsafe_allow_html=True)
 
 # Notionクライアントの初期化
+# クライアント(とHTTPセッション)はリランをまたいで使い回す
+@st.cache_resource(show_spinner=False)
+def get_wrapper():
+    return NotionWrapper()
+
+
+# プロジェクト一覧のキャッシュ (リランごとのNotion問い合わせを回避)
+# 名前 -> ID (選択用) と ID -> 名前 (表示用) の辞書もまとめてキャッシュする
+# プロジェクトはほとんど変わらないので、再起動後も使えるようディスクに永続化する
+# (永続キャッシュはTTLに対応していないため、更新は Refresh Projects ボタンで行う)
+# DB IDをキャッシュキーに含め、PROJECT_DB_ID を変更したときに古い一覧が残らないようにする
+# 取得失敗時は例外を送出させ、失敗した結果がディスクに永続化されないようにする (エラー表示は呼び出し側で行う)
+@st.cache_data(persist="disk", show_spinner=False)
+def load_project_maps(project_db_id):
+    projects = get_wrapper().fetch_projects()
+    name_to_id = {p["name"]: p["id"] for p in projects}
+    id_to_name = {p["id"]: p["name"] for p in projects}
+    return name_to_id, id_to_name
+
+
+# タスク一覧のキャッシュ (チェックボックス操作などの無関係なリランで再取得しない)
+# プロジェクト一覧と並列に取得できるよう、プロジェクト名の解決は呼び出し側で行う
+# Daily Tasks に表示する候補 (今日のタスク + 過去の未完了タスク) だけをNotion側で絞り込んで取得する
+@st.cache_data(ttl=30, show_spinner=False)
+def load_tasks(database_id, today_str, page_size):
+    return get_wrapper().get_daily_tasks(
+        today_str,
+        _NOT_STARTED_STATUSES | _IN_PROGRESS_STATUSES,
+        page_size=page_size,
+        resolve_projects=False
+    )
+
+
+# ワーカースレッドからもst.*を呼べるよう、現在のスクリプト実行コンテキストを引き継ぐ
+def _executor(max_workers):
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    )
+
+
 try:
-    wrapper = NotionWrapper()
+    wrapper = get_wrapper()
     is_connected = True
+    connect_error = None
 except Exception as e:
-    st.error("Notionとの連携設定が完了していません。secrets.tomlに `NOTION_TOKEN`, `DATABASE_ID`, `PROJECT_DB_ID` を設定してください。")
-    st.warning(f"Error: {e}")
     is_connected = False
+    connect_error = e
 
+# 共通データ (プロジェクト一覧 + タスク一覧) の取得を先に開始し、
+# CSSやタイトルの描画と並行してNotionとの通信を進める
+# 互いに独立したI/Oなので並列に取得する
+# プロジェクトの辞書はセッションに保持済みなら取得しない (キャッシュからの復元コストも省く)
+# スレッドプールはこの実行専用に作り、セッション間で共有しない
+fut_projects = None
+today_str = datetime.now().strftime("%Y-%m-%d")
+if is_connected:
+    loader = _executor(2)
+    if "project_maps" not in st.session_state:
+        fut_projects = loader.submit(load_project_maps, wrapper.project_db_id)
+    # Fetch a good number of tasks to ensure we cover recent ones
+    fut_tasks = loader.submit(load_tasks, wrapper.database_id, today_str, 100)
 
-# 共通データの読み込み (プロジェクト一覧)
+local_css()
+
+# タイトル
+st.title("✅ Task App")
+
+if not is_connected:
+    st.error("Notionとの連携設定が完了していません。secrets.tomlに `NOTION_TOKEN`, `DATABASE_ID`, `PROJECT_DB_ID` を設定してください。")
+    st.warning(f"Error: {connect_error}")
+
+
+# 共通データの読み込み (プロジェクト一覧 + タスク一覧)
 project_dict = {}
 project_names = []
+df = None
 
 if is_connected:
-    with st.spinner("Loading projects..."):
-        projects = wrapper.get_projects()
+    with st.spinner("Loading..."):
+        try:
+            if fut_projects is not None:
+                try:
+                    st.session_state["project_maps"] = fut_projects.result()
+                except Exception as e:
+                    # 失敗した結果はセッションにも保持せず、次のリランで再取得する
+                    st.error(f"Error fetching projects: {e}")
+            df = fut_tasks.result()
+        finally:
+            loader.shutdown(wait=False)
     
-    # 名前とIDの辞書を作成 (ID -> Name for mapping, Name -> ID for selection)
     # Project selection uses Name -> ID
     # Task display uses ID -> Name
-    project_dict_for_select = {p["name"]: p["id"] for p in projects} # Name -> ID
-    project_map_for_display = {p["id"]: p["name"] for p in projects} # ID -> Name
-    
-    project_names = ["(No Project)"] + list(project_dict_for_select.keys())
+    project_dict_for_select, project_map_for_display = st.session_state.get("project_maps", ({}, {}))
+    project_names = ("(No Project)", *project_dict_for_select)
 else:
     project_dict_for_select = {}
     project_map_for_display = {}
@@ -128,15 +210,20 @@ tab1, tab2 = st.tabs(["📝 Record", "📅 Daily Tasks"])
 # --- Tab 1: Record (Add Task) ---
 with tab1:
     st.header("Add New Task")
-    
-    is_date_enabled = st.checkbox("Set Date", value=False)
 
+    # プロジェクト一覧はキャッシュしているので、Notion側で追加した場合は手動で更新
+    if st.button("🔄 Refresh Projects"):
+        load_project_maps.clear()
+        st.session_state.pop("project_maps", None)
+        st.rerun()
+    
     with st.form("task_form", clear_on_submit=True):
         name = st.text_input("Task Name", placeholder="Enter task name...")
         
-        date = None
-        if is_date_enabled:
-            date = st.date_input("Date", datetime.now())
+        # フォーム内に置くことで、切り替えのたびにスクリプト全体がリランしないようにする
+        # (日付入力は常に表示し、チェックされている場合のみ送信時に使う)
+        is_date_enabled = st.checkbox("Set Date", value=False, key="set_date_checkbox")
+        date_value = st.date_input("Date", datetime.now())
         
         selected_project_name = None
         if project_names:
@@ -153,6 +240,7 @@ with tab1:
                 st.warning("タスク名を入力してください。")
             else:
                 project_id = project_dict_for_select.get(selected_project_name)
+                date = date_value if is_date_enabled else None
                 with st.spinner("Saving to Notion..."):
                     success = wrapper.add_task(
                         name=name,
@@ -160,6 +248,9 @@ with tab1:
                         project_id=project_id
                     )
                     if success:
+                        # Daily Tasksタブは同じ実行内で後から描画されるので、取り直すだけで反映される
+                        load_tasks.clear()
+                        df = load_tasks(wrapper.database_id, today_str, 100)
                         st.success(f"Saved: {name} ({selected_project_name})")
                     else:
                         st.error("保存に失敗しました。ログを確認してください。")
@@ -171,98 +262,106 @@ with tab2:
     if not is_connected:
         st.error("Notion Connection Required")
     else:
-        # Load tasks
-        with st.spinner("Loading tasks..."):
-            # Fetch a good number of tasks to ensure we cover recent ones
-            # Pass project_map so it can resolve project IDs to names
-            df = wrapper.get_tasks(page_size=100, project_map=project_map_for_display)
+        # タスク一覧のキャッシュだけを破棄する (プロジェクト一覧のキャッシュはそのまま)
+        # 最終編集の情報が前回と変わっていなければ、全件の取り直しは行わない
+        if st.button("🔄 Refresh Tasks"):
+            version = wrapper.get_db_version(wrapper.database_id)
+            if version is None or version != st.session_state.get("tasks_version"):
+                st.session_state["tasks_version"] = version
+                load_tasks.clear()
+                st.rerun()
 
+        # プロジェクトIDを名前に解決 (列単位でまとめて変換)
+        if not df.empty:
+            df["Project"] = np.where(
+                df["ProjectID"].isna(),
+                "-",
+                df["ProjectID"].map(project_map_for_display).fillna("Unknown Project")
+            )
 
         if df.empty:
             st.info("No tasks found.")
         else:
-            today_str = datetime.now().strftime("%Y-%m-%d")
-            
             # Filter Logic
             # 1. Date == Today (any status)
             # 2. Date < Today AND Status is (未着手 or 進行中)
             
-            not_started_statuses = ["Not started", "Not Started", "未着手", "To Do", "To-do"]
-            in_progress_statuses = ["In progress", "In Progress", "進行中", "Doing"]
+            # 行ごとのapplyではなく、列単位のブールマスクでまとめて判定する
+            status = df["Status"].astype(str)
+            date = df["Date"].astype(str)
             
-            def is_target_task(row):
-                status = str(row["Status"])
-                date = str(row["Date"])
-                
-                # 日付がnullの場合は除外
-                if date == "-" or date == "":
-                    return False
-                
-                is_not_started = status in not_started_statuses
-                is_in_progress = status in in_progress_statuses
-                is_today = date == today_str
-                is_before_today = date < today_str
-                
-                # 条件1: 開始日が今日と一致
-                if is_today:
-                    return True
-                # 条件2: 開始日が今日より前 AND ステータスが未着手/進行中
-                if is_before_today and (is_not_started or is_in_progress):
-                    return True
-                return False
+            is_not_started = status.isin(_NOT_STARTED_STATUSES)
+            is_in_progress = status.isin(_IN_PROGRESS_STATUSES)
+            # 日付がnullの場合は除外
+            has_date = ~date.isin(["-", ""])
+            is_today = date == today_str
+            is_before_today = date < today_str
+            
+            # 条件1: 開始日が今日と一致
+            # 条件2: 開始日が今日より前 AND ステータスが未着手/進行中
+            mask = has_date & (is_today | (is_before_today & (is_not_started | is_in_progress)))
 
             # Apply filter
-            target_tasks = df[df.apply(is_target_task, axis=1)]
-
             # Sort: In Progress first, then Not Started
-            def sort_key(row):
-                status = str(row["Status"])
-                if status in in_progress_statuses:
-                    return 0 # Top priority
-                return 1
+            target_tasks = (
+                df.loc[mask]
+                .assign(sort_key=np.where(is_in_progress[mask], 0, 1))
+                .sort_values(by=["sort_key", "Date"])
+            )
 
             if not target_tasks.empty:
-                target_tasks["sort_key"] = target_tasks.apply(sort_key, axis=1)
-                target_tasks = target_tasks.sort_values(by=["sort_key", "Date"])
                 
                 # Display tasks
-                for index, row in target_tasks.iterrows():
-                    # レイアウト: タスク名 (左) - ステータス (右)
-                    c1, c2 = st.columns([0.7, 0.3])
-                    
-                    with c1:
-                        # タスク名を大きく表示
-                        st.markdown(f"##### {row['Task']}")
-                        if row['Project'] != "-":
-                            st.caption(f"📂 {row['Project']}")
-                    
-                    with c2:
-                        # Status Updater
-                        current_status = row['Status']
+                # ステータス変更はフォームでまとめ、送信時に一括でNotionへ反映する
+                pending = {}
+                with st.form("status_updates"):
+                    for row in target_tasks.itertuples(index=False):
+                        # レイアウト: タスク名 (左) - ステータス (右)
+                        c1, c2 = st.columns([0.7, 0.3])
                         
-                        # Dynamic options based on current status
-                        options = [current_status] 
-                        for s in ["未着手", "進行中", "完了"]:
-                            if s not in options:
-                                options.append(s)
+                        with c1:
+                            # タスク名を大きく表示 (プロジェクト名と合わせて1つの要素で描画する)
+                            card = f'<div class="task-title">{html.escape(str(row.Task))}</div>'
+                            if row.Project != "-":
+                                card += f'<div class="task-meta">📂 {html.escape(str(row.Project))}</div>'
+                            st.markdown(card, unsafe_allow_html=True)
                         
-                        # Unique key for widgets in loop
-                        new_status = st.selectbox(
-                            "Status",
-                            options=options,
-                            index=0,
-                            key=f"status_{row['id']}",
-                            label_visibility="collapsed"
-                        )
+                        with c2:
+                            # Status Updater
+                            current_status = row.Status
+                            
+                            # Dynamic options based on current status
+                            options = (current_status, *(s for s in _STATUS_ORDER if s != current_status))
+                            
+                            # Unique key for widgets in loop
+                            new_status = st.selectbox(
+                                "Status",
+                                options=options,
+                                index=0,
+                                key=f"status_{row.id}",
+                                label_visibility="collapsed"
+                            )
+                            
+                            if new_status != current_status:
+                                pending[row.id] = new_status
                         
-                        if new_status != current_status:
-                            with st.spinner("Updating..."):
-                                if wrapper.update_task_status(row['id'], new_status):
-                                    st.success("Updated!")
-                                    st.rerun()
-                                else:
-                                    st.error("Failed to update.")
-                    
-                    st.divider()
+                        st.divider()
+
+                    applied = st.form_submit_button("Apply changes")
+
+                if applied and pending:
+                    with st.spinner("Updating..."):
+                        # Notionのレート制限(3 req/s)に合わせて最大3並列で送信
+                        with _executor(3) as ex:
+                            results = list(ex.map(
+                                lambda item: wrapper.update_task_status(*item),
+                                pending.items()
+                            ))
+                    load_tasks.clear()
+                    if all(results):
+                        st.success("Updated!")
+                        st.rerun()
+                    else:
+                        st.error(f"Failed to update {results.count(False)} task(s).")
             else:
                 st.info("No tasks for today! 🎉")
@@ -1,23 +1,181 @@
 import os
 from datetime import datetime
 from notion_client import Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
 import pandas as pd
 import streamlit as st
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
 import re # Added for _sanitize_id
+import random
+import threading
+from operator import itemgetter
+from urllib.parse import unquote
 
-class NotionWrapper:
-    def __init__(self):
-        # Streamlit secrets または環境変数から認証情報を取得
+try:
+    import orjson
+except ImportError: # orjson が無い環境では標準の json でデコードする
+    orjson = None
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+def _json(response):
+    """
+    requests のレスポンスをデコードします。orjson があればそちらを使います (大きなクエリ結果で速い)。
+    """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def _load_secrets(keys):
+    """
+    Streamlit secrets から設定値を取得します。見つからないキーは環境変数を確認します。
+    """
+    values = {}
+    for key in keys:
         try:
-            self.token = st.secrets["NOTION_TOKEN"]
-            self.database_id = st.secrets["DATABASE_ID"] # Task DB ID
-            self.project_db_id = st.secrets["PROJECT_DB_ID"] # Project DB ID
+            values[key] = st.secrets[key]
         except (KeyError, FileNotFoundError):
             # st.secrets がない場合は環境変数を確認
-            self.token = os.getenv("NOTION_TOKEN")
-            self.database_id = os.getenv("DATABASE_ID")
-            self.project_db_id = os.getenv("PROJECT_DB_ID")
+            values[key] = os.getenv(key)
+    return values
+
+
+_SECRETS = _load_secrets((
+    "NOTION_TOKEN", "DATABASE_ID", "PROJECT_DB_ID",
+    # 任意: タスクDBのプロパティ名を指定すると、スキーマの自動取得を省略する
+    "TASK_TITLE_PROP", "TASK_DATE_PROP", "TASK_RELATION_PROP", "TASK_STATUS_PROP", "TASK_STATUS_TYPE"
+))
+
+# NotionのID抽出用 (_sanitize_id)
+_HEX32_RE = re.compile(r'([a-f0-9]{32})')
+_UUID_RE = re.compile(r'([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})')
+
+# タイトルプロパティのIDはどのDBでも "title" 固定
+_TITLE_PROPERTY_ID = "title"
+
+# スキーマキャッシュを last_edited_time で再確認する間隔 (秒)
+_SCHEMA_REVALIDATE = 600
+
+# get_project_map のキャッシュ有効期間 (秒)
+_PROJECT_MAP_TTL = 60
+
+# リトライ設定 (429 / 5xx の場合に再試行する)
+_MAX_RETRIES = 5
+_BACKOFF_BASE = 0.5
+_BACKOFF_MAX = 32
+
+
+def _is_retryable(status, idempotent=True):
+    # 429 はNotion側で処理されていないので常に再試行できるが、
+    # 5xx は処理済みの可能性があるので冪等な呼び出しに限る
+    return status == 429 or (idempotent and status >= 500)
+
+
+def _error_status(e):
+    """
+    API呼び出しの例外からHTTPステータスコードを取り出します (不明な場合は None)。
+    """
+    if isinstance(e, HTTPResponseError):
+        return e.status
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code
+    return None
+
+
+def _backoff_delay(attempt, retry_after=None):
+    """
+    Retry-After ヘッダがあればそれに従い、なければジッター付きの指数バックオフで待ち時間を決めます。
+    """
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(_BACKOFF_BASE * 2 ** attempt + random.random() * 0.5, _BACKOFF_MAX)
+
+
+# ページのプロパティ値を取り出すヘルパー (get_tasks のループ内で使う)
+def _get_title(prop):
+    res = prop.get("title")
+    return res[0]["text"]["content"] if res else ""
+
+
+def _get_date(prop):
+    res = prop.get("date")
+    return res.get("start") if res else ""
+
+
+def _get_relation_id(prop):
+    relation_list = prop.get("relation")
+    return relation_list[0]["id"] if relation_list else None
+
+
+def _get_relation_name(prop, project_map):
+    p_id = _get_relation_id(prop)
+    if not p_id:
+        return "-"
+
+    if project_map and p_id in project_map:
+        return project_map[p_id]
+    return "Unknown Project"
+
+
+def _get_status(prop):
+    # Status or Select
+    t = prop.get("type")
+    if t == "status":
+        return prop.get("status", {}).get("name")
+    elif t == "select":
+        return prop.get("select", {}).get("name") if prop.get("select") else None
+    return None
+
+
+@st.cache_resource(show_spinner=False)
+def _make_client(token):
+    """
+    トークンごとに1つの Notion Client を共有し、内部のHTTP接続プール (keep-alive) を使い回します。
+    保持する keep-alive 接続数はスレッドプールからの並列呼び出しに合わせます。
+    クライアントは全セッションで共有するので、同時接続数の上限は httpx の既定値のままにします。
+    """
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=8)
+    )
+    return Client(auth=token, client=http_client)
+
+
+class _RateLimiter:
+    """
+    Notion API のレート制限 (平均 3 req/s) を超えないよう、リクエストの発行を調整するトークンバケット。
+    複数スレッドから同時に呼ばれても安全です。
+    """
+    def __init__(self, rate: float = 3.0, capacity: int = 3):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            # トークンが足りない場合も先に予約しておき、後続の呼び出しはさらに後ろで待たせる
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class NotionWrapper:
+    def __init__(self):
+        # 認証情報はモジュール読み込み時に一度だけ取得したものを使う
+        self.token = _SECRETS["NOTION_TOKEN"]
+        self.database_id = _SECRETS["DATABASE_ID"] # Task DB ID
+        self.project_db_id = _SECRETS["PROJECT_DB_ID"] # Project DB ID
 
         if not self.token or not self.database_id or not self.project_db_id:
             # 開発中はまだPROJECT_DB_IDが設定されていないかもしれないので、Warningにとどめるか、あるいは必須とするか。
@@ -28,8 +186,72 @@ class NotionWrapper:
             self.database_id = self._sanitize_id(self.database_id)
             self.project_db_id = self._sanitize_id(self.project_db_id)
 
+        # 並列に呼ばれてもNotionのレート制限を超えないよう、全リクエストで共有する
+        self._limiter = _RateLimiter()
+
+        # DBスキーマのキャッシュ (database_id -> {schema, last_edited_time, checked_at})
+        # プロパティ名はほとんど変わらないので使い回す
+        self._schema_cache = {}
+
+        # プロジェクトの ID -> 名前 のキャッシュ (有効期限, dict)
+        self._project_map_cache = None
+
+        # タスクDBのプロパティ名が secrets で指定されていれば、それをスキーマとして使う
+        # (プロパティIDや選択肢は分からないので、プロパティの絞り込みなどは行われない)
+        self._configured_task_schema = None
+        configured = {
+            "title": _SECRETS["TASK_TITLE_PROP"],
+            "date": _SECRETS["TASK_DATE_PROP"],
+            "relation": _SECRETS["TASK_RELATION_PROP"],
+            "status": _SECRETS["TASK_STATUS_PROP"]
+        }
+        if all(configured.values()):
+            self._configured_task_schema = {
+                **configured,
+                "status_type": _SECRETS["TASK_STATUS_TYPE"] or "status",
+                "status_options": None,
+                "ids": {}
+            }
+
         if self.token:
-             self.client = Client(auth=self.token)
+             self.client = _make_client(self.token)
+
+        # 直接APIを叩く場合 (Requests Fallback) も、keep-alive で接続を使い回す
+        self._session = requests.Session()
+        self._session.headers.update({
+            "Authorization": f"Bearer {self.token}",
+            "Notion-Version": "2022-06-28",
+            "Content-Type": "application/json"
+        })
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+    def _call(self, fn, *args, _idempotent=True, **kwargs):
+        """
+        Notion API 呼び出しをレート制限に合わせて実行します。
+        rate_limited (429) や 5xx、タイムアウトの場合は待ってから最大 _MAX_RETRIES 回まで再試行します。
+        ページ作成など冪等でない呼び出しは _idempotent=False を指定してください。
+        その場合、処理済みの可能性がある 5xx / タイムアウトでは再試行せず、429 のみ再試行します。
+        """
+        for attempt in range(_MAX_RETRIES + 1):
+            self._limiter.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except HTTPResponseError as e:
+                if attempt == _MAX_RETRIES or not _is_retryable(e.status, _idempotent):
+                    raise
+                time.sleep(_backoff_delay(attempt, e.headers.get("retry-after")))
+                continue
+            except RequestTimeoutError:
+                if attempt == _MAX_RETRIES or not _idempotent:
+                    raise
+                time.sleep(_backoff_delay(attempt))
+                continue
+
+            # requests フォールバック経由の呼び出しはステータスコードで判定
+            if isinstance(result, requests.Response) and _is_retryable(result.status_code, _idempotent) and attempt < _MAX_RETRIES:
+                time.sleep(_backoff_delay(attempt, result.headers.get("Retry-After")))
+                continue
+            return result
 
     def _sanitize_id(self, id_str):
         """
@@ -38,6 +260,10 @@ class NotionWrapper:
         """
         if not id_str:
             return None
+
+        # すでに32文字のIDだけが渡された場合は正規表現を使わずにそのまま返す
+        if len(id_str) == 32 and id_str.isalnum():
+            return id_str
         
         # 1. クエリパラメータを除去 (?v=...)
         id_str = id_str.split("?")[0]
@@ -49,12 +275,12 @@ class NotionWrapper:
         # 3. "名前-ID" の形式の場合、末尾の32文字(または36文字)を抽出したいが、
         #    簡単な正規表現で 32文字のHEXを探す
         # 32文字のHEX (ハイフンなし)
-        match = re.search(r'([a-f0-9]{32})', id_str)
+        match = _HEX32_RE.search(id_str)
         if match:
             return match.group(1)
         
         # UUID形式 (ハイフンあり)
-        match_uuid = re.search(r'([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})', id_str)
+        match_uuid = _UUID_RE.search(id_str)
         if match_uuid:
             return match_uuid.group(1)
 
@@ -63,34 +289,56 @@ class NotionWrapper:
     def _fetch_db_schema(self, database_id):
         """
         DBのスキーマ情報を取得し、プロパティ名（Date, Title, Relation, Status）を特定します。
+        取得に成功した結果は database_id ごとにキャッシュし、_SCHEMA_REVALIDATE 秒ごとに
+        DBの last_edited_time を確認して、変わっていた場合のみスキーマを作り直します。
         """
+        cached = self._schema_cache.get(database_id)
+        if cached is not None and time.monotonic() - cached["checked_at"] < _SCHEMA_REVALIDATE:
+            return cached["schema"]
+
         # Screenshot defaults
         schema = {
             "title": "名前",
             "date": "実施予定日",
             "relation": "プロジェクト",
-            "status": "ステータス"
+            "status": "ステータス",
+            "status_type": "status", # ステータスプロパティの型 (status or select)
+            "status_options": None, # ステータスの選択肢名のリスト (不明な場合は None)
+            "ids": {} # プロパティ名 -> プロパティID (filter_properties 用)
         }
         
         # Requests fallback for robustness
         url = f"https://api.notion.com/v1/databases/{database_id}"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Notion-Version": "2022-06-28",
-            "Content-Type": "application/json"
-        }
+        fetched = False
         
         try:
-            response = requests.get(url, headers=headers)
+            response = self._call(self._session.get, url)
             if response.status_code == 200:
-                data = response.json()
+                data = _json(response)
+                last_edited_time = data.get("last_edited_time")
+
+                # DBが編集されていなければ、前回のスキーマをそのまま使う
+                if cached is not None and last_edited_time == cached["last_edited_time"]:
+                    cached["checked_at"] = time.monotonic()
+                    return cached["schema"]
+
                 properties = data.get("properties", {})
                 
-                # Identify keys by type
-                titles = [k for k, v in properties.items() if v["type"] == "title"]
-                dates = [k for k, v in properties.items() if v["type"] == "date"]
-                relations = [k for k, v in properties.items() if v["type"] == "relation"]
-                statuses = [k for k, v in properties.items() if v["type"] in ["status", "select"]]
+                # Identify keys by type (1回の走査でまとめて振り分ける)
+                ids = {}
+                titles, dates, relations, statuses = [], [], [], []
+                for k, v in properties.items():
+                    ids[k] = v["id"]
+                    t = v["type"]
+                    if t == "title":
+                        titles.append(k)
+                    elif t == "date":
+                        dates.append(k)
+                    elif t == "relation":
+                        relations.append(k)
+                    elif t == "status" or t == "select":
+                        statuses.append(k)
+                schema["ids"] = ids
                 
                 if titles: schema["title"] = titles[0]
                 if dates: schema["date"] = dates[0]
@@ -104,20 +352,46 @@ class NotionWrapper:
                 if statuses:
                     target_status = next((s for s in statuses if s in ["ステータス", "Status", "status"]), statuses[0])
                     schema["status"] = target_status
+                    status_type = properties[target_status]["type"]
+                    schema["status_type"] = status_type
+                    schema["status_options"] = [
+                        o["name"] for o in properties[target_status].get(status_type, {}).get("options", [])
+                    ]
+
+                # 失敗時のデフォルト値はキャッシュせず、次回もう一度取得を試みる
+                self._schema_cache[database_id] = {
+                    "schema": schema,
+                    "last_edited_time": last_edited_time,
+                    "checked_at": time.monotonic()
+                }
+                fetched = True
                     
             else:
                 pass # Fail silently and use defaults
         except Exception:
             pass # Fail silently and use defaults
+
+        # 再確認に失敗した場合は、デフォルト値より前回のスキーマを優先する
+        # 確認時刻も更新し、障害中に呼び出しのたびに (再試行込みで) DB取得を繰り返さないようにする
+        if not fetched and cached is not None:
+            cached["checked_at"] = time.monotonic()
+            return cached["schema"]
             
         return schema
 
-    def add_task(self, name: str, date: datetime.date = None, project_id: str = None):
+    def _get_task_schema(self):
         """
-        新しいタスクをNotionに追加します。
+        タスクDBのスキーマを返します (2回目以降はキャッシュから返すのでHTTPリクエストは発生しません)。
+        secrets でプロパティ名が指定されている場合は、一度もHTTPリクエストを行いません。
+        """
+        if self._configured_task_schema is not None:
+            return self._configured_task_schema
+        return self._fetch_db_schema(self.database_id)
+
+    def _build_task_properties(self, schema, name: str, date: datetime.date = None, project_id: str = None):
+        """
+        タスク作成用のプロパティを構築します。
         """
-        # DBスキーマから正しいプロパティ名を取得
-        schema = self._fetch_db_schema(self.database_id)
         prop_title = schema["title"]
         prop_date = schema["date"]
         prop_relation = schema["relation"]
@@ -154,8 +428,20 @@ class NotionWrapper:
                 }
             }
 
+        return properties
+
+    def add_task(self, name: str, date: datetime.date = None, project_id: str = None):
+        """
+        新しいタスクをNotionに追加します。
+        """
+        # DBスキーマから正しいプロパティ名を取得
+        schema = self._get_task_schema()
+        properties = self._build_task_properties(schema, name, date, project_id)
+
         try:
-            self.client.pages.create(
+            self._call(
+                self.client.pages.create,
+                _idempotent=False,
                 parent={"database_id": self.database_id},
                 properties=properties
             )
@@ -164,42 +450,49 @@ class NotionWrapper:
             st.error(f"Error adding task: {e}")
             return False
 
+    def add_tasks_bulk(self, records: list, max_workers: int = 3):
+        """
+        複数のタスクをまとめてNotionに追加します。
+        records は add_task と同じキー (name, date, project_id) を持つ dict のリストです。
+        スキーマ取得は1回だけ行い、作成リクエストは並列に送信します (レート制限は _call で共有)。
+        戻り値は records と同じ順序の成否 (bool) のリストです。
+        """
+        schema = self._get_task_schema()
+
+        def create_one(record):
+            properties = self._build_task_properties(
+                schema,
+                record["name"],
+                record.get("date"),
+                record.get("project_id")
+            )
+            try:
+                self._call(
+                    self.client.pages.create,
+                    _idempotent=False,
+                    parent={"database_id": self.database_id},
+                    properties=properties
+                )
+                return True
+            except Exception as e:
+                # ワーカースレッドからは st.error を出せないのでログに残す
+                print(f"Error adding task '{record['name']}': {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            return list(ex.map(create_one, records))
+
     def update_task_status(self, page_id: str, new_status: str):
         """
         タスクのステータスを更新します。
         """
-        schema = self._fetch_db_schema(self.database_id)
+        schema = self._get_task_schema()
         prop_status = schema["status"]
         
-        # ステータスプロパティの型を確認するために一度DB情報を取得してもいいが、
-        # ここでは簡易的にstatus/select両対応できるように試みるか、
-        # あるいは _fetch_db_schema で型も保存しておくとベター。
-        # 今回は、汎用的に使える 'status' or 'select' の update payload を構築する。
         # NOTE: Notion API では Statusプロパティの更新は `{"status": {"name": "Done"}}` 
-        # Selectプロパティの更新は `{"select": {"name": "Done"}}` となる。
-        # 型がわからないと少し厄介だが、とりあえず `status` として送ってみて、だめなら... というのは危ない。
-        # 簡易実装として、プロパティ名をキーにして、中身は {"name": new_status} を送る方法だと
-        # typeを指定しなくてもよいショートカットがあるか？ -> ない。型を指定する必要がある。
-        
-        # 正攻法: プロパティの型を取得する
-        # パフォーマンス向上のため、キャッシュするか、都度取得するか。
-        # ここでは安全のために都度チェック（本来はクラスメンバに保持すべき）
-        prop_type = "status" # default
-        
-        url = f"https://api.notion.com/v1/databases/{self.database_id}"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Notion-Version": "2022-06-28",
-            "Content-Type": "application/json"
-        }
-        try:
-            resp = requests.get(url, headers=headers)
-            if resp.status_code == 200:
-                props = resp.json().get("properties", {})
-                if prop_status in props:
-                    prop_type = props[prop_status]["type"]
-        except:
-            pass
+        # Selectプロパティの更新は `{"select": {"name": "Done"}}` となるので、型を指定する必要がある。
+        # 型はスキーマ取得時に一緒に保存しておき、ここでは追加のリクエストを行わない。
+        prop_type = schema["status_type"]
             
         properties = {
             prop_status: {
@@ -210,87 +503,147 @@ class NotionWrapper:
         }
         
         try:
-            self.client.pages.update(page_id=page_id, properties=properties)
+            self._call(self.client.pages.update, page_id=page_id, properties=properties)
             return True
         except Exception as e:
             st.error(f"Error updating status: {e}")
             return False
 
-    def _query_database(self, database_id, sorts=None, page_size=100):
+    def _query_database(self, database_id, sorts=None, page_size=100, filter_properties=None, start_cursor=None, query_filter=None):
         """
         データベースクエリのラッパー。
         ライブラリのバージョンによって query メソッドがない場合のフォールバックを行います。
+        filter_properties にプロパティIDのリストを渡すと、レスポンスをそのプロパティだけに絞ります。
+        start_cursor には前回レスポンスの next_cursor を渡すと続きのページを取得します。
+        query_filter には Notion の filter オブジェクトを渡します。
         """
         body = {"page_size": page_size}
         if sorts:
             body["sorts"] = sorts
+        if query_filter:
+            body["filter"] = query_filter
+        if start_cursor:
+            body["start_cursor"] = start_cursor
+        if filter_properties:
+            # スキーマから取得したプロパティIDはパーセントエンコード済み (例: "%3AUPp") だが、
+            # httpx / requests がクエリ文字列を組み立てるときに再度エンコードするので、一度デコードしておく
+            filter_properties = [unquote(p) for p in filter_properties]
 
         # 1. 標準の client.databases.query を試す
         if hasattr(self.client.databases, "query"):
-            return self.client.databases.query(
+            kwargs = dict(body)
+            if filter_properties:
+                kwargs["filter_properties"] = filter_properties
+            return self._call(
+                self.client.databases.query,
                 database_id=database_id,
-                **body
+                **kwargs
             )
         
         # 2. 直接APIを叩く (Requests Fallback)
         url = f"https://api.notion.com/v1/databases/{database_id}/query"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Notion-Version": "2022-06-28",
-            "Content-Type": "application/json"
-        }
         
-        response = requests.post(url, headers=headers, json=body)
+        # filter_properties はクエリパラメータとして繰り返し指定する
+        params = {"filter_properties": filter_properties} if filter_properties else None
+        response = self._call(self._session.post, url, params=params, json=body)
         
         if response.status_code != 200:
-            raise Exception(f"API Error {response.status_code}: {response.text}")
+            # ステータスコードで判定できるよう、レスポンス付きの例外にする
+            raise requests.HTTPError(f"API Error {response.status_code}: {response.text}", response=response)
             
-        return response.json()
+        return _json(response)
+
+    def get_db_version(self, database_id):
+        """
+        DB内で最後に編集されたページの (ID, last_edited_time) を返します。
+        1件だけの軽いクエリなので、キャッシュを取り直すべきかどうかの判定に使います。
+        NOTE: last_edited_time は分単位なので、同じページの1分以内の再編集は検知できません。
+        """
+        try:
+            response = self._query_database(
+                database_id=database_id,
+                page_size=1,
+                sorts=[{"timestamp": "last_edited_time", "direction": "descending"}],
+                filter_properties=[_TITLE_PROPERTY_ID]
+            )
+        except Exception as e:
+            print(f"Error fetching db version: {e}")
+            return None
+
+        if not response["results"]:
+            return None
+        page = response["results"][0]
+        return (page["id"], page["last_edited_time"])
+
+    def get_project_map(self):
+        """
+        プロジェクトの ID -> 名前 の辞書を返します。
+        連続したリランで何度も問い合わせないよう、_PROJECT_MAP_TTL 秒間はキャッシュを返します。
+        取得に失敗した場合はキャッシュせずに例外を送出します (UIには何も表示しません)。
+        """
+        cached = self._project_map_cache
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        # 失敗した結果をキャッシュすると、復旧後もTTLの間 "Unknown Project" のままになるので例外はそのまま送出する
+        projects = self.fetch_projects()
+        project_map = {p["id"]: p["name"] for p in projects}
+        self._project_map_cache = (time.monotonic() + _PROJECT_MAP_TTL, project_map)
+        return project_map
 
     def get_projects(self):
         """
         プロジェクトDBからプロジェクト一覧を取得します。
+        失敗した場合はエラーを表示して空のリストを返します。
         """
-        if not self.project_db_id:
-            st.error("PROJECT_DB_ID is not set. Please check secrets.toml.")
+        try:
+            return self.fetch_projects()
+        except Exception as e:
+            st.error(f"Error fetching projects: {e}")
             return []
 
-        # 1. まず "名前" でのソートを試みる
+    def fetch_projects(self):
+        """
+        プロジェクトDBからプロジェクト一覧を取得します (UIには何も表示しません)。
+        名前しか使わないので、レスポンスはタイトルプロパティだけに絞ります。
+        取得に失敗した場合は例外を送出するので、結果をキャッシュする呼び出し側で使ってください。
+        """
+        if not self.project_db_id:
+            raise Exception("PROJECT_DB_ID is not set. Please check secrets.toml.")
+
+        # スキーマ (キャッシュ済み) からタイトルプロパティ名を特定し、1回のクエリで取得する
+        schema = self._fetch_db_schema(self.project_db_id)
+        title_key = schema["title"]
+
         try:
             response = self._query_database(
                 database_id=self.project_db_id,
-                sorts=[{"property": "名前", "direction": "ascending"}]
+                sorts=[{"property": title_key, "direction": "ascending"}],
+                filter_properties=[_TITLE_PROPERTY_ID]
             )
-            return self._parse_projects(response, "名前")
-        except Exception:
-            # "名前" プロパティが存在しない可能性があるため、次は "Name" で試す
-            try:
-                response = self._query_database(
-                    database_id=self.project_db_id,
-                    sorts=[{"property": "Name", "direction": "ascending"}]
-                )
-                return self._parse_projects(response, "Name")
-            except Exception:
-                # それでもダメならソートなしで取得
-                try:
-                    response = self._query_database(
-                        database_id=self.project_db_id
-                    )
-                    
-                    if response["results"]:
-                        # 最初のページのプロパティからタイトルを探す
-                        sample_props = response["results"][0]["properties"]
-                        title_key = next((k for k, v in sample_props.items() if v["id"] == "title"), None) 
-                        if not title_key:
-                            title_key = next((k for k, v in sample_props.items() if v["type"] == "title"), "Name")
-                        
-                        return self._parse_projects(response, title_key)
-                    else:
-                        return []
-                        
-                except Exception as e_final:
-                    st.error(f"Error fetching projects: {e_final}")
-                    return []
+            return self._parse_projects(response, title_key)
+        except Exception as e:
+            # 429 / 5xx などは _call で再試行済みなので、ここで別のクエリを投げ直しても待ち時間が延びるだけ
+            # ソート指定が不正 (400) な場合のみフォールバックする
+            if _error_status(e) != 400:
+                raise
+            # スキーマ取得に失敗してタイトル名が分からない場合は、ソートなしで取得して結果から探す
+            # (ここでも失敗した場合は例外をそのまま呼び出し側へ送出する)
+            response = self._query_database(
+                database_id=self.project_db_id,
+                filter_properties=[_TITLE_PROPERTY_ID]
+            )
+            
+            if response["results"]:
+                # 最初のページのプロパティからタイトルを探す
+                sample_props = response["results"][0]["properties"]
+                title_key = next((k for k, v in sample_props.items() if v["id"] == "title"), None) 
+                if not title_key:
+                    title_key = next((k for k, v in sample_props.items() if v["type"] == "title"), "Name")
+                
+                return self._parse_projects(response, title_key)
+            else:
+                return []
 
     def _parse_projects(self, response, title_key):
         projects = []
@@ -308,21 +661,86 @@ class NotionWrapper:
         
         return projects
 
-    def get_tasks(self, page_size: int = 20, project_map: dict = None):
+    def get_tasks(self, page_size: int = 100, project_map: dict = None, resolve_projects: bool = True):
         """
         タスク履歴を取得します。
+        project_map を省略した場合はプロジェクト一覧を1回だけ取得して Project 列を解決します。
+        呼び出し側で ProjectID 列から解決する場合は resolve_projects=False を指定してください。
+        """
+        df, _ = self.get_tasks_page(page_size=page_size, project_map=project_map, resolve_projects=resolve_projects)
+        return df
+
+    def get_daily_tasks(self, today: str, open_statuses, page_size: int = 100, project_map: dict = None, resolve_projects: bool = True):
+        """
+        today (YYYY-MM-DD) が日付のタスクと、それより前で open_statuses のいずれかのステータスのタスクを取得します。
+        絞り込みは Notion 側で行い、転送・パースするページ数を減らします。
+        """
+        schema = self._get_task_schema()
+        prop_date = schema["date"]
+        prop_status = schema["status"]
+        status_type = schema["status_type"]
+        options = schema["status_options"]
+
+        if options is None:
+            # 選択肢が分からない場合は存在しないステータスで絞り込むとエラーになるので、日付だけで絞る
+            query_filter = {"property": prop_date, "date": {"on_or_before": today}}
+        else:
+            query_filter = {"or": [{"property": prop_date, "date": {"equals": today}}] + [
+                {
+                    "and": [
+                        {"property": prop_date, "date": {"before": today}},
+                        {"property": prop_status, status_type: {"equals": s}}
+                    ]
+                }
+                for s in options if s in open_statuses
+            ]}
+
+        df, _ = self.get_tasks_page(
+            page_size=page_size,
+            project_map=project_map,
+            resolve_projects=resolve_projects,
+            query_filter=query_filter
+        )
+        return df
+
+    def get_tasks_page(self, page_size: int = 100, start_cursor: str = None, project_map: dict = None, resolve_projects: bool = True, query_filter: dict = None):
+        """
+        タスク履歴を1ページ分取得し、(DataFrame, next_cursor) を返します。
+        続きがない場合 next_cursor は None です。
         """
         try:
             # DBスキーマから正しいプロパティ名を取得
-            schema = self._fetch_db_schema(self.database_id)
+            if project_map is None and resolve_projects and self.project_db_id:
+                # スキーマとプロジェクト一覧は独立したI/Oなので並列に取得する
+                with ThreadPoolExecutor(max_workers=2) as ex:
+                    fut_schema = ex.submit(self._get_task_schema)
+                    fut_projects = ex.submit(self.get_project_map)
+                    schema = fut_schema.result()
+                    try:
+                        project_map = fut_projects.result()
+                    except Exception as e:
+                        # ワーカースレッドからは st.error が表示されないので、呼び出し元のスレッドで表示する
+                        st.error(f"Error fetching projects: {e}")
+                        project_map = {}
+            else:
+                schema = self._get_task_schema()
             prop_title = schema["title"]
             prop_date = schema["date"]
             prop_relation = schema["relation"]
             prop_status = schema["status"]
 
+            # 表示に使うプロパティだけを返してもらい、レスポンスを小さくする
+            prop_ids = schema["ids"]
+            filter_properties = [
+                prop_ids[p] for p in (prop_title, prop_date, prop_relation, prop_status) if p in prop_ids
+            ]
+
             response = self._query_database(
                 database_id=self.database_id,
                 page_size=page_size,
+                filter_properties=filter_properties,
+                start_cursor=start_cursor,
+                query_filter=query_filter,
                 sorts=[
                     {
                         "property": prop_date,
@@ -331,56 +749,46 @@ class NotionWrapper:
                 ]
             )
             
-            data = []
+            # スキーマ取得に成功していればプロパティは通常すべて存在するので、行ごとは直接インデックスで取り出す
+            # (取得に失敗してデフォルト名を使っている場合は最初から .get でフォールバック)
+            keys = (prop_title, prop_date, prop_relation, prop_status)
+            safe_pick = lambda props: tuple(props.get(k, {}) for k in keys)
+            if all(k in prop_ids for k in keys):
+                pick = itemgetter(*keys)
+            else:
+                pick = safe_pick
+
+            # 列ごとのリストに直接詰める (行ごとのdictを作ってから転置するより軽い)
+            ids, tasks, dates, project_names, project_ids, statuses = [], [], [], [], [], []
             for page in response["results"]:
                 props = page["properties"]
+                try:
+                    title, date, relation, status = pick(props)
+                except KeyError:
+                    # filter_properties で指定したプロパティが返ってこなかったページは、そのページだけ .get で取り出す
+                    title, date, relation, status = safe_pick(props)
                 
-                # Helper functions
-                def get_title(prop):
-                    res = prop.get("title", [])
-                    return res[0]["text"]["content"] if res else ""
-                
-                def get_date(prop):
-                    res = prop.get("date", {})
-                    return res.get("start") if res else ""
-                
-                def get_relation_name(prop):
-                    relation_list = prop.get("relation", [])
-                    if not relation_list:
-                        return "-"
-                    
-                    p_id = relation_list[0]["id"]
-                    
-                    if project_map and p_id in project_map:
-                        return project_map[p_id]
-                    return "Unknown Project"
-
-                def get_status(prop):
-                    # Status or Select
-                    t = prop.get("type")
-                    if t == "status":
-                        return prop.get("status", {}).get("name")
-                    elif t == "select":
-                        return prop.get("select", {}).get("name") if prop.get("select") else None
-                    return None
-
                 # データ抽出
-                item = {
-                    "id": page["id"],
-                    "Task": get_title(props.get(prop_title, {})),
-                    "Date": get_date(props.get(prop_date, {})),
-                    "Project": get_relation_name(props.get(prop_relation, {})),
-                    "Status": get_status(props.get(prop_status, {}))
-                }
-                data.append(item)
-            
-            if not data:
-                return pd.DataFrame(columns=["id", "Date", "Task", "Project", "Status"])
+                # ProjectID は呼び出し側でプロジェクト名を後から解決できるように残す
+                ids.append(page["id"])
+                tasks.append(_get_title(title))
+                dates.append(_get_date(date))
+                project_names.append(_get_relation_name(relation, project_map))
+                project_ids.append(_get_relation_id(relation))
+                statuses.append(_get_status(status))
 
-            df = pd.DataFrame(data)
-            return df
+            df = pd.DataFrame({
+                "id": ids,
+                "Task": tasks,
+                "Date": dates,
+                "Project": project_names,
+                "ProjectID": project_ids,
+                "Status": statuses
+            })
+            next_cursor = response.get("next_cursor") if response.get("has_more") else None
+            return df, next_cursor
 
         except Exception as e:
             # st.error(f"Error fetching tasks: {e}") # UIがうるさくなるのでprint推奨だが、デバッグ中は便利
             print(f"Error fetching tasks: {e}")
-            return pd.DataFrame()
+            return pd.DataFrame(), None